@@ -100,4 +100,13 @@ async def main():
 
 
 if __name__ == "__main__":
+    # uvloop speeds up every await in the pipeline (transport, LLM, TTS,
+    # memory extraction); it's Linux/macOS only, so fall back quietly
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
     asyncio.run(main())
@@ -1,391 +1,1111 @@
-"""
-Memory extraction using Gemini tool calling via REST API.
-
-Extracts memorable facts from conversation windows. Uses structured output
-via function calling for reliable parsing.
-
-Expected behavior:
-- 70-80% of calls return empty list (nothing memorable)
-- Tool only called when genuine facts are present
-- Empty result = nothing memorable = common case
-
-Note: Uses direct REST API calls via httpx to avoid gRPC credential conflicts
-with service account credentials (GOOGLE_APPLICATION_CREDENTIALS).
-"""
-
-import asyncio
-import os
-import time
-from dataclasses import dataclass, field
-from typing import Awaitable, Callable, List, Optional, Union
-
-import httpx
-from loguru import logger
-
-
-@dataclass
-class ExtractionResult:
-    """
-    Complete result from a memory extraction call.
-
-    Includes all metadata needed for logging, debugging, and analytics.
-    """
-
-    # Extracted memories (empty list if nothing memorable)
-    memories: List[dict] = field(default_factory=list)
-
-    # Status: "success", "no_memories", "error"
-    status: str = "no_memories"
-
-    # Timing
-    duration_ms: int = 0
-
-    # Model info
-    model: str = ""
-
-    # Input context
-    messages: List[dict] = field(default_factory=list)
-    formatted_prompt: str = ""
-
-    # Response details
-    tool_called: bool = False
-    raw_response_text: Optional[str] = None
-    finish_reason: Optional[str] = None
-
-    # Token usage from usageMetadata
-    prompt_tokens: int = 0
-    completion_tokens: int = 0
-    total_tokens: int = 0
-
-    # Error info (if status == "error")
-    error_message: Optional[str] = None
-
-    # Optional identity context (for logging)
-    user_id: Optional[str] = None
-    agent_id: Optional[str] = None
-    session_id: Optional[str] = None
-    trigger_message_count: Optional[int] = None
-
-
-# Type alias for extraction callbacks
-ExtractionCallback = Callable[[ExtractionResult], Union[None, Awaitable[None]]]
-
-
-EXTRACTION_SYSTEM_PROMPT = """You analyze conversations to extract memorable facts about the user.
-
-Only store facts that are:
-- Explicitly stated or strongly implied by the USER (not the assistant)
-- Worth remembering for future conversations
-- Not just conversational filler ("yeah", "okay", "tell me more")
-- NEW information not already obvious from context
-
-DO NOT extract:
-- The user's name (already known to the system)
-- Temporary states like "user is tired" or "user is busy today"
-- Things the assistant said or suggested
-- Vague statements with no specific facts
-
-Most conversation windows have NOTHING worth storing. That's normal — just respond without calling the tool.
-
-Categories:
-- identity: Location, job, family members, age, background (NOT name)
-- preference: Likes, dislikes, communication style, explicit requests
-- context: Current projects, problems, life events in progress
-- relationship: Shared moments, emotional references, inside jokes
-- surprise: Unusual or unexpected facts that stand out
-
-Importance scale (1-5):
-- 5: Core identity (where they live, what they do, family)
-- 4: Important relationships or major life events
-- 3: Notable preferences or ongoing situations
-- 2: Interesting but not critical details
-- 1: Minor details worth noting
-"""
-
-
-def _get_store_memories_tool_declaration() -> dict:
-    """Build the tool declaration dictionary for memory extraction.
-
-    Uses the Gemini API function declaration format.
-    """
-    return {
-        "name": "store_memories",
-        "description": (
-            "Store memorable facts about the user. "
-            "Only call this if there are facts worth remembering. "
-            "Most conversations have nothing memorable — that's fine, "
-            "just don't call this tool."
-        ),
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "memories": {
-                    "type": "array",
-                    "description": "List of memorable facts to store",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "content": {
-                                "type": "string",
-                                "description": (
-                                    "The fact in third person, e.g. "
-                                    "'User's brother Mike works at Google'"
-                                ),
-                            },
-                            "category": {
-                                "type": "string",
-                                "enum": [
-                                    "identity",
-                                    "preference",
-                                    "context",
-                                    "relationship",
-                                    "surprise",
-                                ],
-                                "description": (
-                                    "identity=core facts, preference=likes/dislikes, "
-                                    "context=current projects/problems, "
-                                    "relationship=emotional moments, "
-                                    "surprise=unusual/noteworthy"
-                                ),
-                            },
-                            "importance": {
-                                "type": "integer",
-                                "description": "1-5 scale: 5=core identity, 1=minor detail",
-                            },
-                        },
-                        "required": ["content", "category", "importance"],
-                    },
-                },
-            },
-            "required": ["memories"],
-        },
-    }
-
-
-async def extract_memories(
-    messages: List[dict],
-    model_name: Optional[str] = None,
-    api_key: Optional[str] = None,
-    # Identity context for logging
-    user_id: Optional[str] = None,
-    agent_id: Optional[str] = None,
-    session_id: Optional[str] = None,
-    trigger_message_count: Optional[int] = None,
-    # Callback for observability
-    on_complete: Optional[ExtractionCallback] = None,
-    # Custom system prompt
-    system_prompt: Optional[str] = None,
-) -> List[dict]:
-    """
-    Extract memories from a conversation window using Gemini tool calling.
-
-    Uses the Gemini REST API directly via httpx to avoid gRPC credential
-    conflicts with service account credentials.
-
-    Args:
-        messages: List of message dicts with 'role' and 'content' keys
-        model_name: Gemini model to use (default: gemini-2.0-flash-lite)
-        api_key: Gemini API key (default: from GOOGLE_API_KEY env)
-        user_id: Optional user ID for logging/callbacks
-        agent_id: Optional agent ID for logging/callbacks
-        session_id: Optional session ID for logging/callbacks
-        trigger_message_count: Optional message count when extraction was triggered
-        on_complete: Optional callback called with ExtractionResult after extraction
-        system_prompt: Custom system prompt for extraction (default: EXTRACTION_SYSTEM_PROMPT)
-
-    Returns:
-        List of memory dicts with keys: content, category, importance
-        Empty list if nothing memorable (common case).
-    """
-    start_time = time.perf_counter()
-
-    if model_name is None:
-        model_name = os.getenv("BRAINFART_GEMINI_MODEL", "gemini-2.0-flash")
-
-    # Get API key - explicit priority order
-    key = api_key or os.getenv("BRAINFART_GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-    if not key:
-        logger.warning("No Gemini API key found for memory extraction")
-        return []
-
-    # Format conversation for the prompt
-    conversation = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
-
-    # Build the REST API request
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-
-    # Build request payload with tool declaration
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": f"Analyze this conversation for memorable facts:\n\n{conversation}"}],
-            }
-        ],
-        "systemInstruction": {
-            "parts": [{"text": system_prompt or EXTRACTION_SYSTEM_PROMPT}]
-        },
-        "tools": [
-            {
-                "functionDeclarations": [_get_store_memories_tool_declaration()]
-            }
-        ],
-        "generationConfig": {
-            "temperature": 0.3,
-        },
-    }
-
-    # Track extraction metadata for callback
-    memories_result = []
-    status = "no_memories"
-    tool_called = False
-    raw_response_text = None
-    finish_reason = None
-    error_message = None
-    prompt_tokens = 0
-    completion_tokens = 0
-    total_tokens = 0
-
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                params={"key": key},
-                json=payload,
-                timeout=30.0,
-            )
-            response.raise_for_status()
-            result = response.json()
-
-        # Extract token usage metadata
-        usage = result.get("usageMetadata", {})
-        prompt_tokens = usage.get("promptTokenCount", 0)
-        completion_tokens = usage.get("candidatesTokenCount", 0)
-        total_tokens = usage.get("totalTokenCount", 0)
-
-        # Parse the response
-        candidates = result.get("candidates", [])
-        if not candidates:
-            status = "no_memories"
-        else:
-            candidate = candidates[0]
-
-            # Capture finish reason
-            finish_reason = candidate.get("finishReason")
-
-            content = candidate.get("content", {})
-            parts = content.get("parts", [])
-
-            if not parts:
-                status = "no_memories"
-            else:
-                # Look for function call in response
-                for part in parts:
-                    # Capture any text response
-                    if "text" in part:
-                        raw_response_text = part["text"]
-
-                    # Check for function call
-                    if "functionCall" in part:
-                        fc = part["functionCall"]
-                        if fc.get("name") == "store_memories":
-                            tool_called = True
-                            # Extract structured memories from function call args
-                            args = fc.get("args", {})
-                            memories = args.get("memories", [])
-
-                            # Convert to plain dicts
-                            for m in memories:
-                                if isinstance(m, dict):
-                                    memories_result.append({
-                                        "content": str(m.get("content", "")),
-                                        "category": str(m.get("category", "context")),
-                                        "importance": int(m.get("importance", 3)),
-                                    })
-
-                if memories_result:
-                    status = "success"
-                    elapsed_ms = (time.perf_counter() - start_time) * 1000
-                    logger.info(f"Extracted {len(memories_result)} memories ({elapsed_ms:.0f}ms)")
-
-    except httpx.HTTPStatusError as e:
-        logger.error(f"Memory extraction HTTP error: {e.response.status_code} - {e.response.text}")
-        status = "error"
-        error_message = f"HTTP {e.response.status_code}: {e.response.text}"
-    except Exception as e:
-        logger.error(f"Memory extraction failed: {e}")
-        status = "error"
-        error_message = str(e)
-
-    # Calculate duration
-    duration_ms = int((time.perf_counter() - start_time) * 1000)
-
-    # Call callback if provided
-    if on_complete is not None:
-        extraction_result = ExtractionResult(
-            memories=memories_result,
-            status=status,
-            duration_ms=duration_ms,
-            model=model_name,
-            messages=messages,
-            formatted_prompt=conversation,
-            tool_called=tool_called,
-            raw_response_text=raw_response_text,
-            finish_reason=finish_reason,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=total_tokens,
-            error_message=error_message,
-            user_id=user_id,
-            agent_id=agent_id,
-            session_id=session_id,
-            trigger_message_count=trigger_message_count,
-        )
-
-        # Handle both sync and async callbacks
-        try:
-            result = on_complete(extraction_result)
-            if asyncio.iscoroutine(result):
-                await result
-        except Exception as e:
-            logger.warning(f"Extraction callback failed: {e}")
-
-    return memories_result
-
-
-async def extract_and_store(
-    messages: List[dict],
-    memory: "LocalMemory",
-    session_id: Optional[str] = None,
-    turn_number: Optional[int] = None,
-    system_prompt: Optional[str] = None,
-) -> int:
-    """
-    Extract memories and store them.
-
-    Convenience function that combines extraction and storage.
-
-    Args:
-        messages: Conversation window to analyze
-        memory: LocalMemory instance
-        session_id: Optional session ID for tracking
-        turn_number: Optional turn number for tracking
-        system_prompt: Custom system prompt for extraction
-
-    Returns:
-        Number of memories stored (0 if nothing memorable)
-    """
-    from .memory import LocalMemory
-
-    memories = await extract_memories(messages, system_prompt=system_prompt)
-
-    if not memories:
-        return 0
-
-    await memory.store_batch(
-        memories,
-        session_id=session_id,
-        turn_number=turn_number,
-    )
-
-    return len(memories)
+"""
+Memory extraction using Gemini tool calling via REST API.
+
+Extracts memorable facts from conversation windows. Uses structured output
+via function calling for reliable parsing.
+
+Expected behavior:
+- 70-80% of calls return empty list (nothing memorable)
+- Tool only called when genuine facts are present
+- Empty result = nothing memorable = common case
+
+Note: Uses direct REST API calls via httpx to avoid gRPC credential conflicts
+with service account credentials (GOOGLE_APPLICATION_CREDENTIALS).
+"""
+
+import asyncio
+import copy
+import itertools
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Final, List, Optional, Tuple, Union
+
+import numpy as np
+import orjson
+import tenacity
+import xxhash
+
+from loguru import logger
+
+# HTTP backend selection. httpxr is a Rust-backed drop-in for the httpx API
+# that moves TLS, HTTP, and body assembly out of Python (lower per-request
+# CPU and GIL hold time). Opt in with BRAINFART_HTTP_BACKEND=httpxr; falls
+# back to httpx if httpxr isn't installed (pip install brainfart[rust-http]).
+if os.getenv("BRAINFART_HTTP_BACKEND") == "httpxr":
+    try:
+        import httpxr as httpx
+    except ImportError:
+        import httpx
+
+        logger.warning(
+            "BRAINFART_HTTP_BACKEND=httpxr but httpxr is not installed; "
+            "falling back to httpx. Install with: pip install brainfart[rust-http]"
+        )
+else:
+    import httpx
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Gemini 429s are common during bursts and usually clear in under a second;
+# bounded backoff with jitter keeps a whole conversation window from being
+# dropped over a transient error. Three attempts stay well inside the 30s
+# client timeout.
+_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _is_transient_error(exc: BaseException) -> bool:
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in _RETRYABLE_STATUS_CODES
+    )
+
+
+_transient_retry = tenacity.retry(
+    retry=tenacity.retry_if_exception(_is_transient_error),
+    wait=tenacity.wait_exponential_jitter(initial=0.2, max=2.0),
+    stop=tenacity.stop_after_attempt(3),
+    reraise=True,
+)
+
+# Shared HTTP client - reused across extractions so TCP connections and TLS
+# sessions to the Gemini endpoint survive between calls. With HTTP/2 enabled,
+# concurrent extractions multiplex over a single connection.
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Get the shared AsyncClient, creating it lazily on first use.
+
+    No lock needed: this is synchronous, so it can't be interleaved
+    by other tasks on the same event loop.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+            timeout=30.0,
+        )
+    return _client
+
+
+# Exact-match LRU cache over recent extraction windows. Consecutive windows
+# overlap heavily (same N-1 messages plus one new utterance), and a
+# byte-identical window always yields the same memories — skip the Gemini
+# round trip entirely on a repeat.
+_CACHE_MAXSIZE = 512
+_extract_cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+
+# In-flight deduplication (single-flight): when two tasks request the same
+# window concurrently, the second awaits the first's future instead of
+# issuing its own call. Pairs with the LRU cache above, which only helps
+# once the first request has completed.
+_inflight: Dict[str, "asyncio.Future[List[dict]]"] = {}
+
+
+def _cache_key(model_name: str, system_prompt: str, conversation: str) -> str:
+    """Hash the inputs that determine the extraction result.
+
+    xxh3 hashes the multi-KB prompt text at memory speed; this runs on the
+    event loop before any await, and cache keys don't need cryptographic
+    collision resistance.
+    """
+    buf = f"{model_name}\x00{system_prompt}\x00{conversation}".encode()
+    return xxhash.xxh3_64_hexdigest(buf)
+
+
+# Lexical pre-filter: a cheap scan for first-person fact markers before
+# spending an API round trip. Windows with zero signals (the dominant case)
+# are skipped outright; windows dense with signals are escalated from
+# Flash-Lite to the heavier Flash model. Disable with
+# BRAINFART_EXTRACTION_PREFILTER=0.
+_FACT_MARKERS = re.compile(
+    r"\b(?:i(?:'m| am)|i live|i work|i have|i like|i love|i hate|i prefer|"
+    r"i moved|i(?:'ve| have) been|my \w+|we (?:live|have|moved))\b",
+    re.IGNORECASE,
+)
+
+_DEFAULT_MODEL = "gemini-2.0-flash-lite"
+_ESCALATION_MODEL = "gemini-2.0-flash"
+_ESCALATION_MARKER_COUNT = 4
+
+
+def _prefilter_enabled() -> bool:
+    return os.getenv("BRAINFART_EXTRACTION_PREFILTER", "1").lower() not in ("0", "false", "no")
+
+
+def _count_fact_markers(conversation: str) -> int:
+    """Count lexical signals that a window might contain real facts.
+
+    Marker phrases, TitleCase words (a proper-noun proxy), and tokens with
+    digits all count. Zero means the window is almost certainly filler.
+    """
+    count = len(_FACT_MARKERS.findall(conversation))
+    for token in conversation.split():
+        if token.istitle() or any(c.isdigit() for c in token):
+            count += 1
+    return count
+
+
+# Semantic cache (opt-in via BRAINFART_SEMANTIC_CACHE=1): neighbouring windows
+# usually differ only by filler ("okay", "tell me more") that never produces
+# memories, so a window very close to one that recently returned nothing can
+# skip Gemini too. Only empty results are cached to keep false positives
+# harmless. Reuses the package's fastembed EmbeddingService, which the memory
+# store has typically already loaded.
+_SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+_SEMANTIC_CACHE_SIZE = 64  # ring buffer entries per user
+
+_semantic_cache: Dict[str, Deque[Tuple[np.ndarray, List[dict]]]] = {}
+
+
+def _semantic_cache_enabled() -> bool:
+    return os.getenv("BRAINFART_SEMANTIC_CACHE", "").lower() in ("1", "true", "yes")
+
+
+async def _embed_conversation(conversation: str) -> np.ndarray:
+    """Embed a conversation window with the shared embedding service."""
+    from .embeddings import EmbeddingService
+
+    service = EmbeddingService(os.getenv("BRAINFART_EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    return await service.embed(conversation)
+
+
+def _semantic_cache_lookup(
+    user_id: Optional[str], query_embedding: np.ndarray
+) -> Optional[List[dict]]:
+    """Return a cached result if a recent window is close enough, else None."""
+    buf = _semantic_cache.get(user_id or "")
+    if not buf:
+        return None
+
+    # Vectorized cosine similarity (embeddings are normalized)
+    embeddings = np.stack([entry[0] for entry in buf])
+    sims = embeddings @ query_embedding
+
+    best = int(np.argmax(sims))
+    if float(sims[best]) > _SEMANTIC_SIMILARITY_THRESHOLD:
+        return copy.deepcopy(buf[best][1])
+    return None
+
+
+def _semantic_cache_store(
+    user_id: Optional[str], query_embedding: np.ndarray, memories: List[dict]
+) -> None:
+    """Add a window's result to the per-user ring buffer."""
+    buf = _semantic_cache.setdefault(
+        user_id or "", deque(maxlen=_SEMANTIC_CACHE_SIZE)
+    )
+    buf.append((query_embedding, copy.deepcopy(memories)))
+
+
+# Gemini context caching (opt-in via BRAINFART_CONTEXT_CACHE=1): the system
+# prompt and tool schema are identical on every call, so they can be uploaded
+# once as a cachedContent and referenced by name — cheaper input tokens and no
+# server-side re-tokenization. Gemini enforces a minimum cacheable token count,
+# so this stays opt-in and falls back to inlining when the API refuses.
+_CONTEXT_CACHE_TTL_S = 3600
+_CONTEXT_CACHE_REFRESH_MARGIN_S = 60
+
+# One entry per model: the prefilter routes between flash-lite and flash, and
+# each model needs its own cachedContents (keying on a single model would
+# recreate a server-side entry on every switch, each billed for its full TTL)
+_context_caches: Dict[str, Tuple[str, float]] = {}  # model -> (name, expires_at)
+_context_cache_failed = False
+_context_cache_lock = asyncio.Lock()
+
+
+def _context_cache_enabled() -> bool:
+    return os.getenv("BRAINFART_CONTEXT_CACHE", "").lower() in ("1", "true", "yes")
+
+
+def _context_cache_get(model_name: str, now: float) -> Optional[str]:
+    """Return the model's cached name if still comfortably inside its TTL."""
+    entry = _context_caches.get(model_name)
+    if entry is not None and now < entry[1] - _CONTEXT_CACHE_REFRESH_MARGIN_S:
+        return entry[0]
+    return None
+
+
+async def _get_context_cache(model_name: str, key: str) -> Optional[str]:
+    """Get (or lazily create/refresh) the cachedContent for the static content.
+
+    Returns None when caching is unavailable and extraction falls back to
+    inlining the prompt and tools. A 4xx rejection (e.g. the content is below
+    Gemini's minimum cacheable token count) latches caching off for the
+    process — the API would reject it every time — while transient errors
+    just retry on the next call.
+    """
+    global _context_cache_failed
+
+    if _context_cache_failed:
+        return None
+
+    name = _context_cache_get(model_name, time.time())
+    if name is not None:
+        return name
+
+    async with _context_cache_lock:
+        # Re-check after acquiring the lock (another task may have refreshed)
+        now = time.time()
+        name = _context_cache_get(model_name, now)
+        if name is not None:
+            return name
+
+        try:
+            client = _get_client()
+            response = await client.post(
+                "https://generativelanguage.googleapis.com/v1beta/cachedContents",
+                params={"key": key},
+                json={
+                    "model": f"models/{model_name}",
+                    "systemInstruction": _SYS_INSTR_FIELD,
+                    "tools": _TOOLS_FIELD,
+                    "ttl": f"{_CONTEXT_CACHE_TTL_S}s",
+                },
+            )
+            response.raise_for_status()
+            data = response.json()
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code < 500:
+                logger.warning(
+                    f"Gemini context cache rejected, inlining prompt/tools: {e}"
+                )
+                _context_cache_failed = True
+            else:
+                logger.warning(f"Gemini context cache create failed, will retry: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"Gemini context cache create failed, will retry: {e}")
+            return None
+
+        name = data.get("name")
+        if not name:
+            return None
+        _context_caches[model_name] = (name, now + _CONTEXT_CACHE_TTL_S)
+        logger.debug(f"Created Gemini context cache {name} for {model_name}")
+        return name
+
+
+async def aclose_client() -> None:
+    """Close the shared HTTP client (call on shutdown).
+
+    Safe to call multiple times; the client is recreated lazily if
+    extraction runs again afterwards. Also stops any batcher workers.
+    """
+    global _client
+    for batcher in _batchers.values():
+        await batcher.aclose()
+    _batchers.clear()
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+@dataclass
+class ExtractionResult:
+    """
+    Complete result from a memory extraction call.
+
+    Includes all metadata needed for logging, debugging, and analytics.
+    """
+
+    # Extracted memories (empty list if nothing memorable)
+    memories: List[dict] = field(default_factory=list)
+
+    # Status: "success", "no_memories", "error",
+    # "cache_hit", "semantic_cache_hit", "prefiltered", "coalesced"
+    status: str = "no_memories"
+
+    # Timing
+    duration_ms: int = 0
+
+    # Model info
+    model: str = ""
+
+    # Input context
+    messages: List[dict] = field(default_factory=list)
+    formatted_prompt: str = ""
+
+    # Response details
+    tool_called: bool = False
+    raw_response_text: Optional[str] = None
+    finish_reason: Optional[str] = None
+
+    # Token usage from usageMetadata
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+    # Error info (if status == "error")
+    error_message: Optional[str] = None
+
+    # Optional identity context (for logging)
+    user_id: Optional[str] = None
+    agent_id: Optional[str] = None
+    session_id: Optional[str] = None
+    trigger_message_count: Optional[int] = None
+
+
+# Type alias for extraction callbacks
+ExtractionCallback = Callable[[ExtractionResult], Union[None, Awaitable[None]]]
+
+
+EXTRACTION_SYSTEM_PROMPT = """You analyze conversations to extract memorable facts about the user.
+
+Only store facts that are:
+- Explicitly stated or strongly implied by the USER (not the assistant)
+- Worth remembering for future conversations
+- Not just conversational filler ("yeah", "okay", "tell me more")
+- NEW information not already obvious from context
+
+DO NOT extract:
+- The user's name (already known to the system)
+- Temporary states like "user is tired" or "user is busy today"
+- Things the assistant said or suggested
+- Vague statements with no specific facts
+
+Most conversation windows have NOTHING worth storing. That's normal — just respond without calling the tool.
+
+Categories:
+- identity: Location, job, family members, age, background (NOT name)
+- preference: Likes, dislikes, communication style, explicit requests
+- context: Current projects, problems, life events in progress
+- relationship: Shared moments, emotional references, inside jokes
+- surprise: Unusual or unexpected facts that stand out
+
+Importance scale (1-5):
+- 5: Core identity (where they live, what they do, family)
+- 4: Important relationships or major life events
+- 3: Notable preferences or ongoing situations
+- 2: Interesting but not critical details
+- 1: Minor details worth noting
+"""
+
+
+def _get_store_memories_tool_declaration() -> dict:
+    """Build the tool declaration dictionary for memory extraction.
+
+    Uses the Gemini API function declaration format.
+    """
+    return {
+        "name": "store_memories",
+        "description": (
+            "Store memorable facts about the user. "
+            "Only call this if there are facts worth remembering. "
+            "Most conversations have nothing memorable — that's fine, "
+            "just don't call this tool."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "memories": {
+                    "type": "array",
+                    "description": "List of memorable facts to store",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "content": {
+                                "type": "string",
+                                "description": (
+                                    "The fact in third person, e.g. "
+                                    "'User's brother Mike works at Google'"
+                                ),
+                            },
+                            "category": {
+                                "type": "string",
+                                "enum": [
+                                    "identity",
+                                    "preference",
+                                    "context",
+                                    "relationship",
+                                    "surprise",
+                                ],
+                                "description": (
+                                    "identity=core facts, preference=likes/dislikes, "
+                                    "context=current projects/problems, "
+                                    "relationship=emotional moments, "
+                                    "surprise=unusual/noteworthy"
+                                ),
+                            },
+                            "importance": {
+                                "type": "integer",
+                                "description": "1-5 scale: 5=core identity, 1=minor detail",
+                            },
+                            "session_id": {
+                                "type": "string",
+                                "description": (
+                                    "Identifier of the conversation window this fact "
+                                    "came from (only when analyzing multiple windows)"
+                                ),
+                            },
+                        },
+                        "required": ["content", "category", "importance"],
+                    },
+                },
+            },
+            "required": ["memories"],
+        },
+    }
+
+
+# Micro-batching (opt-in via BRAINFART_EXTRACTION_BATCH=1): when several bots
+# or sessions queue extractions close together, each paid its own round trip.
+# The batcher collects windows for up to 50ms (or 8 windows) and sends them
+# to Gemini as one request with tagged windows; memories come back with a
+# session_id field and fan out to each caller's future.
+_BATCH_MAX_SIZE = 8
+_BATCH_MAX_WAIT_S = 0.05
+
+_window_ids = itertools.count(1)
+
+
+def _batching_enabled() -> bool:
+    return os.getenv("BRAINFART_EXTRACTION_BATCH", "").lower() in ("1", "true", "yes")
+
+
+class _ExtractionBatcher:
+    """Collects extraction windows briefly and issues one Gemini call.
+
+    One batcher exists per (model, api key) pair. Callers submit a formatted
+    conversation and await a future; a background worker drains the queue,
+    tags each window with a session_id, and routes the returned memories back
+    by tag.
+    """
+
+    def __init__(self, model_name: str, api_key: str):
+        self.model_name = model_name
+        self.api_key = api_key
+        self._queue: "asyncio.Queue[Tuple[str, str, asyncio.Future]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight_batch: List[Tuple[str, str, asyncio.Future]] = []
+
+    async def submit(self, conversation: str) -> List[dict]:
+        """Queue a window and wait for its share of the batched response."""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        window_id = str(next(_window_ids))
+        await self._queue.put((window_id, conversation, future))
+        return await future
+
+    async def aclose(self) -> None:
+        """Cancel the worker and fail every pending future.
+
+        Cancelling the worker alone would leave queued and mid-flight
+        submitters awaiting forever; each unresolved future gets a
+        RuntimeError so callers degrade to an empty error result.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        error = RuntimeError("extraction batcher closed")
+        for _, _, future in self._inflight_batch:
+            if not future.done():
+                future.set_exception(error)
+        self._inflight_batch = []
+        while True:
+            try:
+                _, _, future = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if not future.done():
+                future.set_exception(error)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Expose the batch as soon as the first window is popped — from
+            # here until the response, these futures live in neither the
+            # queue nor a result, so aclose must be able to fail them
+            # whether the worker is cancelled during collection or mid-flush
+            # (_flush itself never raises, so the reset below always runs)
+            self._inflight_batch = batch
+            deadline = loop.time() + _BATCH_MAX_WAIT_S
+            while len(batch) < _BATCH_MAX_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+            self._inflight_batch = []
+
+    async def _flush(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        """Send one request covering every window in the batch."""
+        text = "\n\n".join(
+            f"=== WINDOW session_id={window_id} ===\n{conversation}"
+            for window_id, conversation, _ in batch
+        )
+        payload = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [
+                        {
+                            "text": (
+                                "Analyze each conversation window below for memorable "
+                                "facts. Tag every memory with the session_id of the "
+                                f"window it came from:\n\n{text}"
+                            )
+                        }
+                    ],
+                }
+            ],
+            **_STATIC_PAYLOAD_BASE,
+        }
+        # A batched response carries memories for up to 8 windows — don't
+        # let the solo-call output cap truncate it
+        payload["generationConfig"] = {
+            **_STATIC_PAYLOAD_BASE["generationConfig"],
+            "maxOutputTokens": 2048,
+        }
+        url = (
+            "https://generativelanguage.googleapis.com/v1beta/models/"
+            f"{self.model_name}:generateContent"
+        )
+
+        # Any failure — the POST or a malformed response (e.g. a non-numeric
+        # importance) — must fan out to every waiter, or the futures hang and
+        # the worker dies with them
+        try:
+            result = await _post_generate(url, {"key": self.api_key}, payload)
+
+            # Group returned memories by their session_id tag
+            grouped: Dict[str, List[dict]] = {
+                window_id: [] for window_id, _, _ in batch
+            }
+            for candidate in result.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    fc = part.get("functionCall")
+                    if not fc or fc.get("name") != "store_memories":
+                        continue
+                    for m in fc.get("args", {}).get("memories", []):
+                        if not isinstance(m, dict):
+                            continue
+                        target = grouped.get(str(m.get("session_id", "")))
+                        if target is None:
+                            # Untagged memory is only safe to attribute when
+                            # the batch holds a single window
+                            if len(batch) != 1:
+                                continue
+                            target = grouped[batch[0][0]]
+                        target.append(
+                            {
+                                "content": str(m.get("content", "")),
+                                "category": str(m.get("category", "context")),
+                                "importance": int(m.get("importance", 3)),
+                            }
+                        )
+
+            for window_id, _, future in batch:
+                if not future.done():
+                    future.set_result(grouped[window_id])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+_batchers: Dict[Tuple[str, str], _ExtractionBatcher] = {}
+
+
+def _get_batcher(model_name: str, api_key: str) -> _ExtractionBatcher:
+    batcher = _batchers.get((model_name, api_key))
+    if batcher is None:
+        batcher = _ExtractionBatcher(model_name, api_key)
+        _batchers[(model_name, api_key)] = batcher
+    return batcher
+
+
+# Built once at import: the tool schema, system instruction, and generation
+# config are identical on every call, so the per-call payload only needs a
+# fresh "contents" entry merged on top. Never mutate these in place — the
+# sub-trees are shared across all requests.
+_TOOL_DECL: Final[dict] = _get_store_memories_tool_declaration()
+_SYS_INSTR_FIELD: Final[dict] = {"parts": [{"text": EXTRACTION_SYSTEM_PROMPT}]}
+_TOOLS_FIELD: Final[List[dict]] = [{"functionDeclarations": [_TOOL_DECL]}]
+_STATIC_PAYLOAD_BASE: Final[dict] = {
+    "systemInstruction": _SYS_INSTR_FIELD,
+    "tools": _TOOLS_FIELD,
+    # One candidate is all we read, and the tool call is small — capping
+    # output keeps the filler-text path from rambling
+    "generationConfig": {"temperature": 0.3, "candidateCount": 1, "maxOutputTokens": 256},
+}
+
+# HTTP field mask: the parser only reads function calls, text, the finish
+# reason, and token usage — let the server omit safety ratings, citation
+# metadata, and prompt feedback instead of shipping and decoding them
+_RESPONSE_FIELD_MASK: Final = (
+    "usageMetadata,candidates(content(parts(functionCall,text)),finishReason)"
+)
+
+
+def _extraction_backend() -> str:
+    """Which Gemini transport to use: "rest" (default) or "genai".
+
+    The "genai" backend routes through the legacy google-generativeai SDK
+    (pip install brainfart[legacy-genai]) for users who need it for
+    compatibility; both backends share the same parsing path.
+    """
+    return os.getenv("BRAINFART_EXTRACTION_BACKEND", "rest")
+
+
+def _parse_candidate(candidate: dict) -> Tuple[List[dict], bool, Optional[str], Optional[str]]:
+    """Parse one response candidate.
+
+    Returns (memories, tool_called, raw_text, finish_reason). Accepts both
+    the REST camelCase shape and the snake_case dicts produced by the legacy
+    SDK's protobuf conversion.
+    """
+    finish_reason = candidate.get("finishReason") or candidate.get("finish_reason")
+    parts = candidate.get("content", {}).get("parts", [])
+
+    # Single lookups instead of a branchy per-part loop: the dominant
+    # response has one part and no function call at all
+    fc_part = next((p for p in parts if "functionCall" in p or "function_call" in p), None)
+    text_part = next((p for p in parts if "text" in p), None)
+    raw_text = text_part["text"] if text_part else None
+
+    memories: List[dict] = []
+    tool_called = False
+    if fc_part is not None:
+        fc = fc_part.get("functionCall") or fc_part["function_call"]
+        if fc.get("name") == "store_memories":
+            tool_called = True
+            args = fc.get("args") or {}
+            # Convert structured memories to plain dicts in one comprehension
+            memories = [
+                {
+                    "content": str(m.get("content", "")),
+                    "category": str(m.get("category", "context")),
+                    "importance": int(m.get("importance", 3)),
+                }
+                for m in args.get("memories", [])
+                if isinstance(m, dict)
+            ]
+
+    return memories, tool_called, raw_text, finish_reason
+
+
+async def _generate_rest(
+    model_name: str,
+    key: str,
+    conversation: str,
+    system_prompt: Optional[str],
+) -> dict:
+    """Call generateContent over REST and return the decoded response."""
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
+
+    # Per-call payload: only "contents" changes, the rest is the shared
+    # static skeleton (top-level dict is fresh, so keys can be replaced
+    # or dropped without touching the skeleton itself)
+    payload = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [
+                    {"text": f"Analyze this conversation for memorable facts:\n\n{conversation}"}
+                ],
+            }
+        ],
+        **_STATIC_PAYLOAD_BASE,
+    }
+    if system_prompt is not None:
+        payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+
+    # With context caching, the static prompt and tool schema live
+    # server-side — reference them by name instead of re-sending
+    if system_prompt is None and _context_cache_enabled():
+        context_cache_name = await _get_context_cache(model_name, key)
+        if context_cache_name:
+            del payload["systemInstruction"]
+            del payload["tools"]
+            payload["cachedContent"] = context_cache_name
+
+    if _streaming_enabled():
+        return await _stream_generate(model_name, key, payload)
+
+    return await _post_generate(url, {"key": key, "fields": _RESPONSE_FIELD_MASK}, payload)
+
+
+@_transient_retry
+async def _post_generate(url: str, params: dict, payload: dict) -> dict:
+    """POST a generateContent payload, retrying transient upstream errors."""
+    client = _get_client()
+    # orjson serializes straight to bytes, ~3-10x faster than the
+    # stdlib json that httpx's json= kwarg would use
+    response = await client.post(
+        url,
+        params=params,
+        content=orjson.dumps(payload),
+        headers=_JSON_HEADERS,
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def _streaming_enabled() -> bool:
+    """Whether to stream responses (opt-in via BRAINFART_EXTRACTION_STREAM=1).
+
+    Streaming cuts tail latency by closing the connection as soon as the
+    function call arrives, at the cost of token counts being absent from
+    ExtractionResult when the stream is cut short.
+    """
+    return os.getenv("BRAINFART_EXTRACTION_STREAM", "").lower() in ("1", "true", "yes")
+
+
+@_transient_retry
+async def _stream_generate(model_name: str, key: str, payload: dict) -> dict:
+    """POST to streamGenerateContent (SSE) and stop reading early.
+
+    Most responses carry no functionCall, and the trailing usage metadata
+    and safety ratings are dead weight either way. Chunks are aggregated
+    into a generateContent-shaped dict; once a functionCall part shows up
+    the rest of the stream is abandoned (the call arrives as one complete
+    part).
+    """
+    url = (
+        "https://generativelanguage.googleapis.com/v1beta/models/"
+        f"{model_name}:streamGenerateContent"
+    )
+    parts: List[dict] = []
+    finish_reason: Optional[str] = None
+    usage: dict = {}
+
+    client = _get_client()
+    async with client.stream(
+        "POST",
+        url,
+        params={"key": key, "alt": "sse"},
+        content=orjson.dumps(payload),
+        headers=_JSON_HEADERS,
+    ) as response:
+        if response.status_code >= 400:
+            # Load the body so the error handler can read response.text
+            await response.aread()
+            response.raise_for_status()
+
+        got_function_call = False
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if not data or data == "[DONE]":
+                continue
+
+            chunk = orjson.loads(data)
+            usage = chunk.get("usageMetadata", usage)
+            for candidate in chunk.get("candidates", []):
+                finish_reason = candidate.get("finishReason", finish_reason)
+                parts.extend(candidate.get("content", {}).get("parts", []))
+                if any("functionCall" in p for p in parts):
+                    got_function_call = True
+
+            if got_function_call:
+                # Nothing left worth reading — closing the stream here skips
+                # the remaining body transfer
+                break
+
+    return {
+        "candidates": [{"content": {"parts": parts}, "finishReason": finish_reason}],
+        "usageMetadata": usage,
+    }
+
+
+async def _generate_genai(
+    model_name: str,
+    key: str,
+    conversation: str,
+    system_prompt: Optional[str],
+) -> dict:
+    """Call Gemini through the legacy google-generativeai SDK.
+
+    The response is converted to a plain dict so _parse_candidate can be
+    shared with the REST backend (keys come back snake_case).
+    """
+    import google.generativeai as genai
+
+    genai.configure(api_key=key)
+    model = genai.GenerativeModel(
+        model_name,
+        system_instruction=system_prompt or EXTRACTION_SYSTEM_PROMPT,
+        tools=[{"function_declarations": [_TOOL_DECL]}],
+    )
+    response = await model.generate_content_async(
+        f"Analyze this conversation for memorable facts:\n\n{conversation}",
+        generation_config={"temperature": 0.3},
+    )
+    return response.to_dict()
+
+
+async def extract_memories(
+    messages: List[dict],
+    model_name: Optional[str] = None,
+    api_key: Optional[str] = None,
+    # Identity context for logging
+    user_id: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    trigger_message_count: Optional[int] = None,
+    # Callback for observability
+    on_complete: Optional[ExtractionCallback] = None,
+    # Custom system prompt
+    system_prompt: Optional[str] = None,
+    # Pre-rendered "ROLE: content" lines (avoids re-formatting the overlap)
+    formatted_messages: Optional[List[str]] = None,
+) -> List[dict]:
+    """
+    Extract memories from a conversation window using Gemini tool calling.
+
+    Uses the Gemini REST API directly via httpx to avoid gRPC credential
+    conflicts with service account credentials.
+
+    Args:
+        messages: List of message dicts with 'role' and 'content' keys
+        model_name: Gemini model to use (default: gemini-2.0-flash-lite)
+        api_key: Gemini API key (default: from GOOGLE_API_KEY env)
+        user_id: Optional user ID for logging/callbacks
+        agent_id: Optional agent ID for logging/callbacks
+        session_id: Optional session ID for logging/callbacks
+        trigger_message_count: Optional message count when extraction was triggered
+        on_complete: Optional callback called with ExtractionResult after extraction
+        system_prompt: Custom system prompt for extraction (default: EXTRACTION_SYSTEM_PROMPT)
+        formatted_messages: Pre-rendered "ROLE: content" lines matching messages.
+            Callers that format each message once on arrival (like
+            MemoryProcessor) pass these to skip re-rendering the whole
+            window every turn.
+
+    Returns:
+        List of memory dicts with keys: content, category, importance
+        Empty list if nothing memorable (common case).
+    """
+    start_time = time.perf_counter()
+
+    if model_name is None:
+        model_name = os.getenv("BRAINFART_GEMINI_MODEL", _DEFAULT_MODEL)
+
+    # Get API key - explicit priority order
+    key = api_key or os.getenv("BRAINFART_GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    if not key:
+        logger.warning("No Gemini API key found for memory extraction")
+        return []
+
+    # Format conversation for the prompt; windows overlap heavily turn to
+    # turn, so callers that render each message once pass the lines in
+    if formatted_messages is not None:
+        conversation = "\n".join(formatted_messages)
+    else:
+        conversation = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+
+    # Cheap lexical scan before anything else: skip windows with no fact-like
+    # signals, escalate signal-dense ones to the heavier model (only when the
+    # caller hasn't pinned a non-default model)
+    marker_count = _count_fact_markers(conversation) if _prefilter_enabled() else None
+    if (
+        marker_count is not None
+        and marker_count >= _ESCALATION_MARKER_COUNT
+        and model_name == _DEFAULT_MODEL
+    ):
+        model_name = _ESCALATION_MODEL
+
+    # Check the exact-match cache before building the request
+    cache_key = _cache_key(model_name, system_prompt or EXTRACTION_SYSTEM_PROMPT, conversation)
+    cached = None
+    cache_status = "cache_hit"
+    query_embedding: Optional[np.ndarray] = None
+    if marker_count != 0:
+        cached = _extract_cache.get(cache_key)
+
+        # Fall back to the semantic cache for near-identical windows (opt-in)
+        if cached is None and _semantic_cache_enabled():
+            query_embedding = await _embed_conversation(conversation)
+            cached = _semantic_cache_lookup(user_id, query_embedding)
+            if cached is not None:
+                cache_status = "semantic_cache_hit"
+
+    # Track extraction metadata for callback
+    memories_result = []
+    status = "no_memories"
+    tool_called = False
+    raw_response_text = None
+    finish_reason = None
+    error_message = None
+    prompt_tokens = 0
+    completion_tokens = 0
+    total_tokens = 0
+
+    if marker_count == 0:
+        # Pure filler — nothing to extract, don't spend the round trip
+        status = "prefiltered"
+    elif cached is not None:
+        # Window matches a recent extraction — reuse its result
+        if cache_status == "cache_hit":
+            _extract_cache.move_to_end(cache_key)
+        memories_result = copy.deepcopy(cached)
+        tool_called = bool(memories_result)
+        status = cache_status
+    elif (inflight := _inflight.get(cache_key)) is not None:
+        # An identical request is already on the wire — piggyback on it
+        memories_result = copy.deepcopy(await inflight)
+        tool_called = bool(memories_result)
+        status = "coalesced"
+    else:
+        # Register as the in-flight owner so concurrent identical calls
+        # coalesce onto this request instead of racing to Gemini
+        owner_future: "asyncio.Future[List[dict]]" = (
+            asyncio.get_running_loop().create_future()
+        )
+        _inflight[cache_key] = owner_future
+        try:
+            if _batching_enabled() and system_prompt is None:
+                # Hand off to the micro-batcher; several concurrent windows
+                # share one Gemini round trip
+                try:
+                    memories_result = await _get_batcher(model_name, key).submit(conversation)
+                    tool_called = bool(memories_result)
+                    if memories_result:
+                        status = "success"
+                        elapsed_ms = (time.perf_counter() - start_time) * 1000
+                        logger.info(
+                            f"Extracted {len(memories_result)} memories (batched, {elapsed_ms:.0f}ms)"
+                        )
+                except Exception as e:
+                    logger.error(f"Batched memory extraction failed: {e}")
+                    status = "error"
+                    error_message = str(e)
+            else:
+                try:
+                    if _extraction_backend() == "genai":
+                        result = await _generate_genai(model_name, key, conversation, system_prompt)
+                    else:
+                        result = await _generate_rest(model_name, key, conversation, system_prompt)
+
+                    # Extract token usage metadata (snake_case when coming from
+                    # the legacy SDK's protobuf conversion)
+                    usage = result.get("usageMetadata") or result.get("usage_metadata") or {}
+                    prompt_tokens = usage.get("promptTokenCount", usage.get("prompt_token_count", 0))
+                    completion_tokens = usage.get(
+                        "candidatesTokenCount", usage.get("candidates_token_count", 0)
+                    )
+                    total_tokens = usage.get("totalTokenCount", usage.get("total_token_count", 0))
+
+                    # Parse the response
+                    candidates = result.get("candidates", [])
+                    if candidates:
+                        memories_result, tool_called, raw_response_text, finish_reason = (
+                            _parse_candidate(candidates[0])
+                        )
+
+                    if memories_result:
+                        status = "success"
+                        elapsed_ms = (time.perf_counter() - start_time) * 1000
+                        logger.info(f"Extracted {len(memories_result)} memories ({elapsed_ms:.0f}ms)")
+
+                except httpx.HTTPStatusError as e:
+                    logger.error(f"Memory extraction HTTP error: {e.response.status_code} - {e.response.text}")
+                    status = "error"
+                    error_message = f"HTTP {e.response.status_code}: {e.response.text}"
+                except Exception as e:
+                    logger.error(f"Memory extraction failed: {e}")
+                    status = "error"
+                    error_message = str(e)
+
+            # Cache everything except errors (the empty result is the common case)
+            if status != "error":
+                _extract_cache[cache_key] = copy.deepcopy(memories_result)
+                if len(_extract_cache) > _CACHE_MAXSIZE:
+                    _extract_cache.popitem(last=False)
+
+                # Only empty results go in the semantic cache — a near-match on a
+                # window that produced real memories is too risky to replay
+                if query_embedding is not None and not memories_result:
+                    _semantic_cache_store(user_id, query_embedding, memories_result)
+        finally:
+            owner_future.set_result(copy.deepcopy(memories_result))
+            del _inflight[cache_key]
+
+    # Calculate duration
+    duration_ms = int((time.perf_counter() - start_time) * 1000)
+
+    # Call callback if provided
+    if on_complete is not None:
+        extraction_result = ExtractionResult(
+            memories=memories_result,
+            status=status,
+            duration_ms=duration_ms,
+            model=model_name,
+            messages=messages,
+            formatted_prompt=conversation,
+            tool_called=tool_called,
+            raw_response_text=raw_response_text,
+            finish_reason=finish_reason,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens,
+            error_message=error_message,
+            user_id=user_id,
+            agent_id=agent_id,
+            session_id=session_id,
+            trigger_message_count=trigger_message_count,
+        )
+
+        # Handle both sync and async callbacks
+        try:
+            result = on_complete(extraction_result)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.warning(f"Extraction callback failed: {e}")
+
+    return memories_result
+
+
+async def extract_and_store(
+    messages: List[dict],
+    memory: "LocalMemory",
+    session_id: Optional[str] = None,
+    turn_number: Optional[int] = None,
+    system_prompt: Optional[str] = None,
+) -> int:
+    """
+    Extract memories and store them.
+
+    Convenience function that combines extraction and storage.
+
+    Args:
+        messages: Conversation window to analyze
+        memory: LocalMemory instance
+        session_id: Optional session ID for tracking
+        turn_number: Optional turn number for tracking
+        system_prompt: Custom system prompt for extraction
+
+    Returns:
+        Number of memories stored (0 if nothing memorable)
+    """
+    from .memory import LocalMemory
+
+    memories = await extract_memories(messages, system_prompt=system_prompt)
+
+    if not memories:
+        return 0
+
+    await memory.store_batch(
+        memories,
+        session_id=session_id,
+        turn_number=turn_number,
+    )
+
+    return len(memories)
@@ -6,7 +6,8 @@ Integrates with Pipecat pipelines to:
 2. Retrieve relevant memories to enrich LLM context
 """
 
-from typing import Dict, List, Optional
+import asyncio
+from typing import Dict, List, Optional, Tuple
 
 from loguru import logger
 from pipecat.frames.frames import (
@@ -19,10 +20,22 @@ from pipecat.processors.frame_processor import FrameProcessor, FrameDirection
 
 from .config import MemorySettings, get_settings
 from .crypto import MemoryCrypto
-from .extraction import extract_memories
+from .extraction import aclose_client, extract_memories
 from .memory import LocalMemory, MemoryResult
 
 
+# Background extraction keeps Gemini latency off the voice pipeline's
+# critical path. Extraction is best-effort, so the queue is small and drops
+# the oldest pending window under pressure.
+_EXTRACTION_QUEUE_SIZE = 4
+_EXTRACTION_WORKER_COUNT = 2
+
+# Extraction's module-level state (HTTP client, batchers) is shared by every
+# processor in the process — multi-agent setups run several at once — so it
+# is only torn down when the last live processor cleans up.
+_live_processor_count = 0
+
+
 class MemoryProcessor(FrameProcessor):
     """
     Pipecat processor that adds conversational memory.
@@ -111,10 +124,22 @@ class MemoryProcessor(FrameProcessor):
         # Lazy-initialize memory system
         self._memory: Optional[LocalMemory] = None
 
-        # Conversation buffer for extraction
+        # Conversation buffer for extraction, plus pre-rendered "ROLE: content"
+        # lines kept in lockstep so each message is formatted exactly once
         self._conversation_buffer: List[Dict[str, str]] = []
+        self._rendered_buffer: List[str] = []
         self._message_count = 0
 
+        # Background extraction queue and workers (started on first use)
+        self._extraction_queue: "asyncio.Queue[Tuple[List[Dict[str, str]], List[str]]]" = (
+            asyncio.Queue(maxsize=_EXTRACTION_QUEUE_SIZE)
+        )
+        self._extraction_workers: List[asyncio.Task] = []
+
+        global _live_processor_count
+        _live_processor_count += 1
+        self._cleaned_up = False
+
         if not self._settings.gemini_api_key and extract_memories:
             logger.warning(
                 "No Gemini API key found. Set PIPECAT_MEMORY_GEMINI_API_KEY or "
@@ -162,6 +187,7 @@ class MemoryProcessor(FrameProcessor):
 
         # Add to conversation buffer
         self._conversation_buffer.append({"role": "user", "content": text})
+        self._rendered_buffer.append(f"USER: {text}")
         self._message_count += 1
 
         # Trigger extraction periodically
@@ -172,17 +198,57 @@ class MemoryProcessor(FrameProcessor):
             await self._extract_from_buffer()
 
     async def _extract_from_buffer(self) -> None:
-        """Extract memories from conversation buffer."""
+        """Queue the current window for background extraction.
+
+        The voice pipeline never waits on Gemini: a hiccup in extraction
+        latency only delays memory writes, not audio.
+        """
         if not self._conversation_buffer:
             return
 
         # Take recent window
-        window = self._conversation_buffer[-self._settings.extraction_window_size :]
-
+        window_size = self._settings.extraction_window_size
+        window = self._conversation_buffer[-window_size:]
+        rendered = self._rendered_buffer[-window_size:]
+
+        self._ensure_extraction_workers()
+
+        # Drop the oldest pending window under pressure — extraction is
+        # best-effort and a fresher window supersedes it anyway
+        if self._extraction_queue.full():
+            try:
+                self._extraction_queue.get_nowait()
+                self._extraction_queue.task_done()
+            except asyncio.QueueEmpty:
+                pass
+        self._extraction_queue.put_nowait((window, rendered))
+
+    def _ensure_extraction_workers(self) -> None:
+        """Start (or restart) the background extraction workers."""
+        self._extraction_workers = [t for t in self._extraction_workers if not t.done()]
+        while len(self._extraction_workers) < _EXTRACTION_WORKER_COUNT:
+            self._extraction_workers.append(asyncio.create_task(self._extract_worker()))
+
+    async def _extract_worker(self) -> None:
+        """Pull queued windows and run extraction off the pipeline path."""
+        while True:
+            window, rendered = await self._extraction_queue.get()
+            try:
+                await self._extract_window(window, rendered)
+            except Exception as e:
+                logger.warning(f"Background extraction failed: {e}")
+            finally:
+                self._extraction_queue.task_done()
+
+    async def _extract_window(
+        self, window: List[Dict[str, str]], rendered: List[str]
+    ) -> None:
+        """Extract memories from one window and store them."""
         memories = await extract_memories(
             messages=window,
             model_name=self._settings.gemini_model,
             api_key=self._settings.gemini_api_key,
+            formatted_messages=rendered,
         )
 
         if memories:
@@ -250,6 +316,7 @@ class MemoryProcessor(FrameProcessor):
         """
         if text.strip():
             self._conversation_buffer.append({"role": "assistant", "content": text})
+            self._rendered_buffer.append(f"ASSISTANT: {text}")
 
     async def get_memories(
         self,
@@ -299,12 +366,35 @@ class MemoryProcessor(FrameProcessor):
 
     async def cleanup(self) -> None:
         """Save and cleanup on shutdown."""
-        # Final extraction
+        # Stop background workers; anything still queued is covered by the
+        # final window below
+        for task in self._extraction_workers:
+            task.cancel()
+        self._extraction_workers.clear()
+
+        # Final extraction (run directly — the workers are gone)
         if self.extract_memories_enabled and self._conversation_buffer:
-            await self._extract_from_buffer()
+            window_size = self._settings.extraction_window_size
+            try:
+                await self._extract_window(
+                    self._conversation_buffer[-window_size:],
+                    self._rendered_buffer[-window_size:],
+                )
+            except Exception as e:
+                logger.warning(f"Final extraction failed: {e}")
 
         # Save and close
         if self._memory:
             await self._memory.close()
 
+        # Release the shared HTTP client and batchers only when this is the
+        # last live processor — closing them earlier would drop other
+        # processors' in-flight extractions. (Recreated lazily if needed.)
+        global _live_processor_count
+        if not self._cleaned_up:
+            self._cleaned_up = True
+            _live_processor_count -= 1
+        if _live_processor_count <= 0:
+            await aclose_client()
+
         logger.info(f"Memory processor cleaned up for {self.agent_id}/{self.user_id}")
@@ -0,0 +1,595 @@
+"""Tests for memory extraction (mocked Gemini transport)."""
+
+import httpx
+import pytest
+
+from brainfart import extraction
+
+
+FACT_MESSAGES = [
+    {"role": "user", "content": "I live in Chicago and my wife Ana works at Google."},
+]
+
+FILLER_MESSAGES = [
+    {"role": "user", "content": "yeah okay tell me more"},
+]
+
+
+def _gemini_response(parts):
+    """Build a minimal generateContent response body."""
+    return {
+        "candidates": [{"content": {"parts": parts}, "finishReason": "STOP"}],
+        "usageMetadata": {
+            "promptTokenCount": 100,
+            "candidatesTokenCount": 20,
+            "totalTokenCount": 120,
+        },
+    }
+
+
+def _function_call_parts(memories):
+    return [
+        {
+            "functionCall": {
+                "name": "store_memories",
+                "args": {"memories": memories},
+            }
+        }
+    ]
+
+
+@pytest.fixture(autouse=True)
+async def clean_state():
+    """Reset module-level caches and the shared client between tests."""
+    extraction._extract_cache.clear()
+    yield
+    extraction._extract_cache.clear()
+    await extraction.aclose_client()
+
+
+def install_mock_transport(handler):
+    """Point the shared client at an httpx.MockTransport."""
+    extraction._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+async def test_extract_parses_function_call():
+    """A store_memories tool call is converted to plain memory dicts."""
+
+    def handler(request):
+        parts = _function_call_parts(
+            [{"content": "User lives in Chicago", "category": "identity", "importance": 5}]
+        )
+        return httpx.Response(200, json=_gemini_response(parts))
+
+    install_mock_transport(handler)
+
+    memories = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert memories == [
+        {"content": "User lives in Chicago", "category": "identity", "importance": 5}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_request_uses_field_mask():
+    """Solo requests ask the server to omit fields the parser never reads."""
+    masks = []
+
+    def handler(request):
+        masks.append(request.url.params.get("fields"))
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing."}]))
+
+    install_mock_transport(handler)
+
+    await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert masks == [extraction._RESPONSE_FIELD_MASK]
+    assert "functionCall" in masks[0]
+
+
+@pytest.mark.asyncio
+async def test_extract_empty_when_no_tool_call():
+    """Text-only responses mean nothing memorable."""
+
+    def handler(request):
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing to store."}]))
+
+    install_mock_transport(handler)
+
+    memories = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+    assert memories == []
+
+
+@pytest.mark.asyncio
+async def test_formatted_messages_skip_rendering():
+    """Pre-rendered lines are used verbatim instead of re-formatting."""
+    import json
+
+    seen = []
+
+    def handler(request):
+        seen.append(json.loads(request.content)["contents"][0]["parts"][0]["text"])
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing."}]))
+
+    install_mock_transport(handler)
+
+    await extraction.extract_memories(
+        FACT_MESSAGES,
+        api_key="test-key",
+        formatted_messages=["USER: I live in Chicago and my wife Ana works at Google."],
+    )
+
+    assert "USER: I live in Chicago and my wife Ana works at Google." in seen[0]
+
+
+@pytest.mark.asyncio
+async def test_no_api_key_returns_empty(monkeypatch):
+    """Missing API key disables extraction instead of raising."""
+    monkeypatch.delenv("BRAINFART_GEMINI_API_KEY", raising=False)
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+
+    memories = await extraction.extract_memories(FACT_MESSAGES)
+    assert memories == []
+
+
+@pytest.mark.asyncio
+async def test_cache_hit_skips_http():
+    """An identical window is served from the cache without a second POST."""
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        parts = _function_call_parts(
+            [{"content": "User lives in Chicago", "category": "identity", "importance": 5}]
+        )
+        return httpx.Response(200, json=_gemini_response(parts))
+
+    install_mock_transport(handler)
+
+    statuses = []
+
+    def on_complete(result):
+        statuses.append(result.status)
+
+    first = await extraction.extract_memories(
+        FACT_MESSAGES, api_key="test-key", on_complete=on_complete
+    )
+    second = await extraction.extract_memories(
+        FACT_MESSAGES, api_key="test-key", on_complete=on_complete
+    )
+
+    assert calls == 1
+    assert first == second
+    assert statuses == ["success", "cache_hit"]
+
+
+@pytest.mark.asyncio
+async def test_cache_returns_copies():
+    """Mutating a returned result must not corrupt the cached entry."""
+
+    def handler(request):
+        parts = _function_call_parts(
+            [{"content": "User has a dog named Max", "category": "identity", "importance": 3}]
+        )
+        return httpx.Response(200, json=_gemini_response(parts))
+
+    install_mock_transport(handler)
+
+    first = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+    first[0]["content"] = "mutated"
+
+    second = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+    assert second[0]["content"] == "User has a dog named Max"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_calls_coalesce():
+    """Two simultaneous calls for the same window share one request."""
+    import asyncio
+
+    calls = 0
+    release = asyncio.Event()
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        parts = _function_call_parts(
+            [{"content": "User lives in Chicago", "category": "identity", "importance": 5}]
+        )
+        return httpx.Response(200, json=_gemini_response(parts))
+
+    install_mock_transport(handler)
+
+    statuses = []
+
+    def on_complete(result):
+        statuses.append(result.status)
+
+    task1 = asyncio.create_task(
+        extraction.extract_memories(FACT_MESSAGES, api_key="test-key", on_complete=on_complete)
+    )
+    task2 = asyncio.create_task(
+        extraction.extract_memories(FACT_MESSAGES, api_key="test-key", on_complete=on_complete)
+    )
+    await asyncio.sleep(0.01)  # let both reach the single-flight gate
+    release.set()
+
+    first, second = await asyncio.gather(task1, task2)
+
+    assert calls == 1
+    assert first == second
+    assert sorted(statuses) == ["coalesced", "success"]
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_hit_for_empty_results(monkeypatch):
+    """A near-identical window reuses a recent empty result (opt-in)."""
+    import numpy as np
+
+    monkeypatch.setenv("BRAINFART_SEMANTIC_CACHE", "1")
+    monkeypatch.setenv("BRAINFART_EXTRACTION_PREFILTER", "0")
+
+    # Same embedding for both windows -> similarity 1.0
+    vec = np.ones(4, dtype=np.float32) / 2.0
+
+    async def fake_embed(conversation):
+        return vec
+
+    monkeypatch.setattr(extraction, "_embed_conversation", fake_embed)
+
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing."}]))
+
+    install_mock_transport(handler)
+
+    statuses = []
+
+    def on_complete(result):
+        statuses.append(result.status)
+
+    first = await extraction.extract_memories(
+        FILLER_MESSAGES, api_key="test-key", user_id="u1", on_complete=on_complete
+    )
+    second = await extraction.extract_memories(
+        [{"role": "user", "content": "okay sure"}],
+        api_key="test-key",
+        user_id="u1",
+        on_complete=on_complete,
+    )
+
+    assert first == [] and second == []
+    assert calls == 1
+    assert statuses == ["no_memories", "semantic_cache_hit"]
+    extraction._semantic_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_prefilter_skips_filler_windows():
+    """Windows with no fact-like signals never reach the API."""
+
+    def handler(request):
+        raise AssertionError("prefiltered window should not POST")
+
+    install_mock_transport(handler)
+
+    statuses = []
+
+    def on_complete(result):
+        statuses.append(result.status)
+
+    memories = await extraction.extract_memories(
+        FILLER_MESSAGES, api_key="test-key", on_complete=on_complete
+    )
+
+    assert memories == []
+    assert statuses == ["prefiltered"]
+
+
+def test_fact_markers_counted():
+    """Marker counting sees first-person phrases, proper nouns, and digits."""
+    assert extraction._count_fact_markers("yeah okay tell me more") == 0
+    assert extraction._count_fact_markers("USER: my brother lives in Denver, he is 34") >= 3
+
+
+@pytest.mark.asyncio
+async def test_context_cache_replaces_static_payload(monkeypatch):
+    """With context caching on, requests reference the cache instead of
+    re-sending the prompt and tool schema."""
+    monkeypatch.setenv("BRAINFART_CONTEXT_CACHE", "1")
+    monkeypatch.setattr(extraction, "_context_caches", {})
+    monkeypatch.setattr(extraction, "_context_cache_failed", False)
+
+    generate_payloads = []
+
+    def handler(request):
+        import json
+
+        if request.url.path.endswith("cachedContents"):
+            return httpx.Response(200, json={"name": "cachedContents/abc123"})
+        generate_payloads.append(json.loads(request.content))
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing."}]))
+
+    install_mock_transport(handler)
+
+    await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert len(generate_payloads) == 1
+    payload = generate_payloads[0]
+    assert payload["cachedContent"] == "cachedContents/abc123"
+    assert "systemInstruction" not in payload
+    assert "tools" not in payload
+
+
+@pytest.mark.asyncio
+async def test_context_cache_transient_error_does_not_latch(monkeypatch):
+    """A 5xx creating the cache falls back to inlining for that request but
+    leaves caching enabled for the next one; only 4xx rejections latch it off."""
+    monkeypatch.setenv("BRAINFART_CONTEXT_CACHE", "1")
+    monkeypatch.setattr(extraction, "_context_caches", {})
+    monkeypatch.setattr(extraction, "_context_cache_failed", False)
+
+    def handler(request):
+        if request.url.path.endswith("cachedContents"):
+            return httpx.Response(503)
+        return httpx.Response(200, json=_gemini_response([{"text": "Nothing."}]))
+
+    install_mock_transport(handler)
+
+    await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert extraction._context_cache_failed is False
+
+
+@pytest.mark.asyncio
+async def test_streaming_parses_sse_chunks(monkeypatch):
+    """Streaming mode assembles SSE chunks into the usual response shape."""
+    import json
+
+    monkeypatch.setenv("BRAINFART_EXTRACTION_STREAM", "1")
+
+    def handler(request):
+        assert request.url.path.endswith("streamGenerateContent")
+        chunk1 = {"candidates": [{"content": {"parts": [{"text": "Found "}]}}]}
+        chunk2 = {
+            "candidates": [
+                {
+                    "content": {
+                        "parts": _function_call_parts(
+                            [
+                                {
+                                    "content": "User lives in Chicago",
+                                    "category": "identity",
+                                    "importance": 5,
+                                }
+                            ]
+                        )
+                    },
+                    "finishReason": "STOP",
+                }
+            ]
+        }
+        body = f"data: {json.dumps(chunk1)}\r\n\r\ndata: {json.dumps(chunk2)}\r\n\r\n"
+        return httpx.Response(
+            200, content=body.encode(), headers={"Content-Type": "text/event-stream"}
+        )
+
+    install_mock_transport(handler)
+
+    memories = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+    assert memories == [
+        {"content": "User lives in Chicago", "category": "identity", "importance": 5}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_batched_extraction_shares_one_request(monkeypatch):
+    """With batching on, concurrent windows go out as one tagged request."""
+    import json
+    import re
+
+    monkeypatch.setenv("BRAINFART_EXTRACTION_BATCH", "1")
+    # Keep both windows on the default model so they share one batcher
+    monkeypatch.setenv("BRAINFART_EXTRACTION_PREFILTER", "0")
+
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        text = json.loads(request.content)["contents"][0]["parts"][0]["text"]
+        window_ids = re.findall(r"session_id=(\d+)", text)
+        assert len(window_ids) == 2
+        memories = [
+            {
+                "content": "User lives in Chicago",
+                "category": "identity",
+                "importance": 5,
+                "session_id": window_ids[0],
+            },
+            {
+                "content": "User plays guitar",
+                "category": "preference",
+                "importance": 3,
+                "session_id": window_ids[1],
+            },
+        ]
+        return httpx.Response(200, json=_gemini_response(_function_call_parts(memories)))
+
+    install_mock_transport(handler)
+
+    import asyncio
+
+    first, second = await asyncio.gather(
+        extraction.extract_memories(FACT_MESSAGES, api_key="test-key"),
+        extraction.extract_memories(
+            [{"role": "user", "content": "I play guitar every Sunday"}],
+            api_key="test-key",
+        ),
+    )
+
+    assert calls == 1
+    assert first == [
+        {"content": "User lives in Chicago", "category": "identity", "importance": 5}
+    ]
+    assert second == [
+        {"content": "User plays guitar", "category": "preference", "importance": 3}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_aclose_fails_inflight_batched_windows(monkeypatch):
+    """Closing the batcher mid-flight fails the waiting extraction instead of
+    leaving it awaiting forever."""
+    import asyncio
+
+    monkeypatch.setenv("BRAINFART_EXTRACTION_BATCH", "1")
+    monkeypatch.setenv("BRAINFART_EXTRACTION_PREFILTER", "0")
+
+    request_started = asyncio.Event()
+
+    async def handler(request):
+        request_started.set()
+        await asyncio.Event().wait()  # hold the request open until cancelled
+
+    install_mock_transport(handler)
+
+    statuses = []
+    task = asyncio.create_task(
+        extraction.extract_memories(
+            FACT_MESSAGES,
+            api_key="test-key",
+            on_complete=lambda r: statuses.append(r.status),
+        )
+    )
+    await request_started.wait()
+    await extraction.aclose_client()
+
+    memories = await asyncio.wait_for(task, timeout=2)
+    assert memories == []
+    assert statuses == ["error"]
+
+
+@pytest.mark.asyncio
+async def test_aclose_fails_windows_popped_during_collection(monkeypatch):
+    """Closing while the worker is still collecting its batch (before any
+    request goes out) fails the popped windows instead of stranding them."""
+    import asyncio
+
+    monkeypatch.setenv("BRAINFART_EXTRACTION_BATCH", "1")
+    monkeypatch.setenv("BRAINFART_EXTRACTION_PREFILTER", "0")
+
+    def handler(request):
+        raise AssertionError("no request should be sent")
+
+    install_mock_transport(handler)
+
+    statuses = []
+    task = asyncio.create_task(
+        extraction.extract_memories(
+            FACT_MESSAGES,
+            api_key="test-key",
+            on_complete=lambda r: statuses.append(r.status),
+        )
+    )
+    # Let the worker pop the window; it then waits out the 50ms batch
+    # deadline for more, so no HTTP request has started yet
+    await asyncio.sleep(0.01)
+    await extraction.aclose_client()
+
+    memories = await asyncio.wait_for(task, timeout=2)
+    assert memories == []
+    assert statuses == ["error"]
+
+
+@pytest.mark.asyncio
+async def test_batched_malformed_response_fails_cleanly(monkeypatch):
+    """A malformed batched response (non-numeric importance) degrades to an
+    empty error result instead of hanging the waiter or killing the worker."""
+    monkeypatch.setenv("BRAINFART_EXTRACTION_BATCH", "1")
+    monkeypatch.setenv("BRAINFART_EXTRACTION_PREFILTER", "0")
+
+    import json
+    import re
+
+    def handler(request):
+        text = json.loads(request.content)["contents"][0]["parts"][0]["text"]
+        window_id = re.findall(r"session_id=(\d+)", text)[0]
+        memories = [
+            {
+                "content": "User lives in Chicago",
+                "category": "identity",
+                "importance": "high",  # not an int
+                "session_id": window_id,
+            }
+        ]
+        return httpx.Response(200, json=_gemini_response(_function_call_parts(memories)))
+
+    install_mock_transport(handler)
+
+    statuses = []
+    memories = await extraction.extract_memories(
+        FACT_MESSAGES, api_key="test-key", on_complete=lambda r: statuses.append(r.status)
+    )
+
+    assert memories == []
+    assert statuses == ["error"]
+
+
+@pytest.mark.asyncio
+async def test_errors_are_not_cached():
+    """An HTTP error should not poison the cache."""
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            # 400 is not retryable, so the first call fails outright
+            return httpx.Response(400, json={"error": "boom"})
+        return httpx.Response(200, json=_gemini_response([{"text": "ok"}]))
+
+    install_mock_transport(handler)
+
+    first = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+    second = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert first == []
+    assert second == []
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried(monkeypatch):
+    """A 429 burst is retried with backoff instead of dropping the window."""
+    import tenacity
+
+    # Skip the backoff sleeps in tests
+    monkeypatch.setattr(extraction._post_generate.retry, "wait", tenacity.wait_none())
+
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            return httpx.Response(429, json={"error": "rate limited"})
+        parts = _function_call_parts(
+            [{"content": "User lives in Chicago", "category": "identity", "importance": 5}]
+        )
+        return httpx.Response(200, json=_gemini_response(parts))
+
+    install_mock_transport(handler)
+
+    memories = await extraction.extract_memories(FACT_MESSAGES, api_key="test-key")
+
+    assert calls == 3
+    assert memories == [
+        {"content": "User lives in Chicago", "category": "identity", "importance": 5}
+    ]